@@ -28,6 +28,8 @@ class DreamerV3():
                  min_reward,
                  max_reward,
                  device,
+                 compile_modules=False,
+                 use_cuda_graph=False,
                  **kwargs):
         
         self.env = env
@@ -56,7 +58,9 @@ class DreamerV3():
                                       min_reward=min_reward,
                                       max_reward=max_reward,
                                       num_blocks=num_blocks,
-                                      device=device)
+                                      device=device,
+                                      compile_modules=compile_modules,
+                                      use_cuda_graph=use_cuda_graph)
         self.memory = Memory(capacity, obs_dim, action_dim, latent_dim, latent_categories_size, device=device)
         self.critic = Critic(recurrent_hidden_dim=model_dim * num_blocks,
                            latent_dim=latent_dim,
@@ -74,6 +78,9 @@ class DreamerV3():
             action_dim=action_dim,
             action_bins=bins,
             device=device)
+        if compile_modules:
+            # The actor is called every imagination step with the same shapes as the world model heads
+            self.actor.compile(mode="reduce-overhead", dynamic=False)
 
         self.env_reset = True
         self.h_0 = None
@@ -1,9 +1,20 @@
+import contextlib
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributions import Normal
 import torch.optim as optim
-import utils
+
+def init_split_linear(fan_in, *layers):
+    """
+    Initializes the parts of a first layer that is split by input like one nn.Linear
+    over the concatenated input: weights and bias uniform in +-1/sqrt(fan_in)
+    """
+    bound = 1 / math.sqrt(fan_in)
+    for layer in layers:
+        for param in layer.parameters():
+            nn.init.uniform_(param, -bound, bound)
 
 # Sequence model:
 #   h_t = f_ϕ(h_{t-1}, z_{t-1}, a_{t-1})
@@ -18,25 +29,39 @@ class SequenceModel(nn.Module):
         self.latent_categories_size = latent_categories_size
         self.device = device
         
-        # Each block has hidden_size = D, and we have 8 of these
-        self.blocks = nn.ModuleList([
-            nn.GRU(
-                input_size=self.input_size,
-                hidden_size=model_dim,
-                batch_first=True
-            )
-            for _ in range(num_blocks)
-        ])
+        # Each block has hidden_size = D, and we have 8 of these.
+        # The blocks are fused into one weight matrix: block i owns the rows
+        # [i * 3 * D, (i + 1) * 3 * D), with the gates ordered (r, z, n) like nn.GRU
+        self.W_ih = nn.Parameter(torch.empty(num_blocks * 3 * model_dim, self.input_size))
+        self.W_hh = nn.Parameter(torch.empty(num_blocks * 3 * model_dim, model_dim))
+        self.b_ih = nn.Parameter(torch.empty(num_blocks * 3 * model_dim))
+        self.b_hh = nn.Parameter(torch.empty(num_blocks * 3 * model_dim))
+        self.reset_parameters()
+
+        # Zero hidden states by batch size, see get_default_hidden
+        self._default_hidden = {}
+
+    def reset_parameters(self):
+        # Same initialization as nn.GRU
+        bound = 1 / math.sqrt(self.model_dim)
+        for weight in self.parameters():
+            nn.init.uniform_(weight, -bound, bound)
     
     def get_default_hidden(self, batch_size=1):
-        return torch.zeros(batch_size, self.model_dim * self.num_blocks, device=self.device)
+        # The zero state is never modified in place, so one tensor per batch size is reused
+        # instead of allocating a new one for every episode and training step
+        if batch_size not in self._default_hidden:
+            self._default_hidden[batch_size] = torch.zeros(batch_size, self.model_dim * self.num_blocks, device=self.device)
+        return self._default_hidden[batch_size]
         #return [None] * self.num_blocks # TODO: The initialization of h as [None] * self.num_blocks in the absence of hidden states may cause issues if the GRU expects tensor inputs. Explicitly initialize h with tensors of appropriate dimensions.
     
-    def forward(self, z, a, h):
+    def forward(self, z, a, h, return_prior=False):
         """
         z: (batch_size, seq_len, latent_size * latent_categories_size)
         a: (batch_size, seq_len, action_size)
         h: (batch_size, model_dim * num_blocks)
+        returns: the next hidden states [h_1, ..., h_L]: (batch_size, seq_len, model_dim * num_blocks),
+                 and if return_prior is set also the previous ones [h_0, ..., h_{L-1}] in the same shape
         """
         assert z.size(0) == a.size(0), "Batch size of z and a must match"
         assert z.size(1) == a.size(1), "Sequence length of z and a must match"
@@ -48,28 +73,89 @@ class SequenceModel(nn.Module):
 
              
         
-        batch_size = z.shape[0]
+        batch_size, seq_len = z.shape[0], z.shape[1]
+        # The blocks of h are used as (batch_size, num_blocks, model_dim), which is a view
+        # of the flat hidden state, so it is never permuted or copied
         h = h.view(batch_size, self.num_blocks, self.model_dim)
-        h = h.permute(1, 0, 2)
-
-        if self.device.type == "cuda":
-            h = h.contiguous() 
-
-        outputs = []        #TODO: check what happens if seq_len is not 1
-        #new_h = []
-        #Forward pass through each GRU block
-        for i, block in enumerate(self.blocks):
-            out_i, h_i = block(x, h[i:i+1])
-            outputs.append(out_i)
-            #new_h.append(h_i)
-        
-        # Concatenate all the block outputs along the last dimension
-        # out_i: (batch_size, seq_len, model_dim)
-        # concatenated: (batch_size, seq_len, num_blocks * model_dim)
-        combined_output = torch.cat(outputs, dim=-1)            # TODO: Check if this is correct and find out how I can use it simply (get back h_t)
-                                                                # TODO: If any GRU changes the sequence length due to different handling of padding or inputs, this will fail
-        
-        return combined_output#, new_h
+
+        # Input projections of all blocks for the whole sequence in one GEMM, outside of the recurrence
+        # x_proj: (batch_size, seq_len, num_blocks, 3 * model_dim)
+        x_proj = self._input_projection(x)
+        W_hh, b_hh_n = self._recurrent_weights()
+
+        # The states [h_0, ..., h_L] are collected in a list and stacked once. Writing every step into a
+        # preallocated buffer would make backward copy the whole buffer's gradient once per step
+        states = [h]
+        for t in range(seq_len):
+            h = self._cell(x_proj[:, t], h, W_hh, b_hh_n)
+            states.append(h)
+        # output: (seq_len + 1, batch_size, num_blocks * model_dim), block i ends up in the i-th
+        # model_dim slice of the last dimension, same as concatenating the blocks.
+        # It is time-major, so both the next states output[1:] and the previous states
+        # output[:-1] are contiguous without shifting h
+        output = torch.stack(states).view(seq_len + 1, batch_size, self.num_blocks * self.model_dim)
+
+        h_next = output[1:].transpose(0, 1)
+        if return_prior:
+            return h_next, output[:-1].transpose(0, 1)
+        return h_next
+
+    def step(self, z, a, h):
+        """
+        Single step of the sequence model without a sequence dimension, used during imagination
+        z: (batch_size, latent_size * latent_categories_size)
+        a: (batch_size, action_size)
+        h: (batch_size, model_dim * num_blocks)
+        returns: (batch_size, model_dim * num_blocks)
+        """
+        batch_size = z.shape[0]
+        x = torch.cat((a, z), dim=-1)
+        x_proj = self._input_projection(x)
+        W_hh, b_hh_n = self._recurrent_weights()
+
+        h = self._cell(x_proj, h.view(batch_size, self.num_blocks, self.model_dim), W_hh, b_hh_n)
+        return h.reshape(batch_size, self.num_blocks * self.model_dim)
+
+    def _input_projection(self, x):
+        """
+        Input projections of all blocks in one GEMM
+        x: (..., input_size)
+        returns: (..., num_blocks, 3 * model_dim)
+        """
+        # The recurrent biases of the r and z gates are simply added to the input projections,
+        # so they are folded into the bias here. Only the n gate's recurrent bias is scaled by r
+        # and has to stay in the recurrence
+        b_ih = self.b_ih.view(self.num_blocks, 3, self.model_dim)
+        b_hh = self.b_hh.view(self.num_blocks, 3, self.model_dim)
+        bias = torch.cat((b_ih[:, :2] + b_hh[:, :2], b_ih[:, 2:]), dim=1).view(-1)
+        return F.linear(x, self.W_ih, bias).view(*x.shape[:-1], self.num_blocks, 3 * self.model_dim)
+
+    def _recurrent_weights(self):
+        """
+        returns: W_hh as (num_blocks, model_dim, 3 * model_dim) for the batched GEMM,
+                 and the n gate's recurrent bias as (num_blocks, model_dim)
+        """
+        W_hh = self.W_hh.view(self.num_blocks, 3 * self.model_dim, self.model_dim).transpose(1, 2)
+        b_hh_n = self.b_hh.view(self.num_blocks, 3, self.model_dim)[:, 2]
+        return W_hh, b_hh_n
+
+    def _cell(self, x_proj, h, W_hh, b_hh_n):
+        """
+        GRU update of all blocks at once
+        x_proj: (batch_size, num_blocks, 3 * model_dim), the input projections, see _input_projection
+        h: (batch_size, num_blocks, model_dim)
+        """
+        # One batched GEMM for the recurrent projections of all blocks, the GEMM reads the
+        # (num_blocks, batch_size, model_dim) transposed view through its strides
+        # h_proj: (batch_size, num_blocks, 3 * model_dim)
+        h_proj = torch.bmm(h.transpose(0, 1), W_hh).transpose(0, 1)
+        x_r, x_z, x_n = x_proj.chunk(3, dim=-1)
+        h_r, h_z, h_n = h_proj.chunk(3, dim=-1)
+
+        r = torch.sigmoid(x_r + h_r)
+        u = torch.sigmoid(x_z + h_z)
+        n = torch.tanh(x_n + r * (h_n + b_hh_n))
+        return n + u * (h - n)         # (1 - u) * n + u * h
     
 # Encoder:
 #   z_t ~ q_ϕ(z_t | h_t, x_t)
@@ -82,8 +168,12 @@ class Encoder(nn.Module):
         self.model_dim = model_dim
         self.latent_categories_size = latent_categories_size
         
+        # The first layer is split into an h and an x part, lin_h(h) + lin_x(x) equals
+        # Linear(cat(h, x)) without materializing the concatenated input
+        self.lin_h = nn.Linear(recurrent_size, model_dim)
+        self.lin_x = nn.Linear(obs_size, model_dim, bias=False)
+        init_split_linear(recurrent_size + obs_size, self.lin_h, self.lin_x)
         self.model = nn.Sequential(
-            nn.Linear(obs_size + recurrent_size, model_dim),
             nn.ReLU(),
             nn.Linear(model_dim, latent_size * latent_categories_size)
         )
@@ -93,20 +183,22 @@ class Encoder(nn.Module):
         x: (batch_size, obs_dim)
         h: (batch_size, model_dim * num_blocks)
         """
-        _x = torch.cat((h, x), dim=-1)
         # Forward pass through the MLP
-        logits = self.model(_x).view(-1, self.latent_size, self.latent_categories_size)
-        # Apply softmax to get probabilities
-        probs = F.softmax(logits, dim=-1)       # TODO: Check dimensions
+        logits = self.model(self.lin_h(h) + self.lin_x(x)).view(-1, self.latent_size, self.latent_categories_size).float()
+        # Log-probabilities for the KL losses, probabilities for sampling
+        log_probs = F.log_softmax(logits, dim=-1)
+        probs = log_probs.exp()
         
-        # Sample from the categorical distribution
-        dist = torch.distributions.Categorical(probs=probs)
-        sampled = dist.sample()  # Sample indices from the categorical distribution
-        hard_sampled = F.one_hot(sampled, num_classes=self.latent_categories_size).float()  # TODO: this assumes that sampled is integer tensor
+        # Sample from the categorical distribution by inverting its CDF, which avoids
+        # building a Categorical object and calling torch.multinomial
+        cdf = probs.detach().cumsum(dim=-1)
+        u = torch.rand(*probs.shape[:-1], 1, device=probs.device)
+        sampled = torch.searchsorted(cdf, u, right=True).clamp_max(self.latent_categories_size - 1)
+        hard_sampled = torch.zeros_like(probs).scatter_(-1, sampled, 1.0)
 
         # Straight-through trick
-        sampled_straight = hard_sampled + probs - probs.detach()
-        return sampled_straight, probs
+        sampled_straight = probs + (hard_sampled - probs).detach()
+        return sampled_straight, log_probs
     
 # Dynamics predictor:
 #   ẑ_t ~ p_ϕ(ẑ_t | h_t)
@@ -126,129 +218,100 @@ class DynamicsPredictor(nn.Module):
 
     def forward(self, h):
         # Forward pass through the MLP
-        logits = self.model(h).view(-1, self.latent_size, self.latent_categories_size)
-        # Apply softmax to get probabilities
-        probs = F.softmax(logits, dim=-1)       # TODO: Check dimensions
+        logits = self.model(h).view(-1, self.latent_size, self.latent_categories_size).float()
+        # Log-probabilities for the KL losses, probabilities for sampling
+        log_probs = F.log_softmax(logits, dim=-1)
+        probs = log_probs.exp()
         
-        # Sample from the categorical distribution
-        dist = torch.distributions.Categorical(probs=probs)
-        sampled = dist.sample()  # Sample indices from the categorical distribution
-        hard_sampled = F.one_hot(sampled, num_classes=self.latent_categories_size).float()
+        # Sample from the categorical distribution by inverting its CDF, which avoids
+        # building a Categorical object and calling torch.multinomial
+        cdf = probs.detach().cumsum(dim=-1)
+        u = torch.rand(*probs.shape[:-1], 1, device=probs.device)
+        sampled = torch.searchsorted(cdf, u, right=True).clamp_max(self.latent_categories_size - 1)
+        hard_sampled = torch.zeros_like(probs).scatter_(-1, sampled, 1.0)
 
         # Straight-through trick
-        sampled_straight = hard_sampled + probs - probs.detach()
-        return sampled_straight, probs
-
-# r̂_t ~ p_ϕ(r̂_t | h_t, z_t)
-class RewardPredictor(nn.Module):   # TODO: initially predicts 0
-    def __init__(self, hidden_dim, latent_dim, embedding_dim, output_dim, model_dim, bins):
-        """
-        Parameters:
-        - hidden_dim: Dimension of the recurrent hidden state h_t
-        - latent_dim: Number of categorical latent variables (each with its own classes)
-        - embedding_dim: Embedding size for each categorical variable
-        - output_dim: Dimension of the predicted output (e.g., reward distribution)
-        - model_dim: Number of units in each hidden layer
-        """
-        super().__init__()
-
-        self.bins = bins
-
-        self.latent_dim = latent_dim
-
-        # Input dimension is hidden state + all embedded latent dimensions
-        input_dim = hidden_dim + embedding_dim * latent_dim
-
-        self.model = nn.Sequential(
-            nn.Linear(input_dim, model_dim),
-            nn.ReLU(),
-            nn.Linear(model_dim, output_dim)
-        )
-
-    def forward(self, h, z,):    # TODO: Check if z is a list of tensors
-        """
-        h: Tensor of shape (batch_size, hidden_dim)
-        z: Tensor of shape (batch_size, latent_dim * embedding_dim)
-        """
- 
-        # Concatenate h with embedded latent variables
-        input_tensor = torch.cat([h, z], dim=-1)
-        r = self.model(input_tensor)
-        return r
-
-# Continue predictor:
-# ĉ_t ~ p_ϕ(ĉ_t | h_t, z_t)
-class ContinuePredictor(nn.Module):
-    def __init__(self, hidden_dim, latent_dim, embedding_dim, output_dim, model_dim):
+        sampled_straight = probs + (hard_sampled - probs).detach()
+        return sampled_straight, log_probs
+
+# The reward predictor, continue predictor and decoder all take (h_t, z_t), so they share
+# one first layer and split into three heads after it:
+#   r̂_t ~ p_ϕ(r̂_t | h_t, z_t)
+#   ĉ_t ~ p_ϕ(ĉ_t | h_t, z_t)
+#   x̂_t ~ p_ϕ(x̂_t | h_t, z_t)
+class PredictionHeads(nn.Module):   # TODO: reward initially predicts 0
+    def __init__(self, hidden_dim, latent_dim, embedding_dim, obs_size, model_dim, bins):
         """
         Parameters:
         - hidden_dim: Dimension of the recurrent hidden state h_t
         - latent_dim: Number of categorical latent variables (each with its own classes)
         - embedding_dim: Embedding size for each categorical variable
-        - output_dim: Dimension of the predicted output (e.g., reward distribution)
-        - model_dim: Number of units in each hidden layer
+        - obs_size: Dimension of the decoded observation
+        - model_dim: Number of units in the hidden layer of each head
         """
         super().__init__()
-
+        self.hidden_dim = hidden_dim
         self.latent_dim = latent_dim
+        self.embedding_dim = embedding_dim
+        self.obs_size = obs_size
+        self.model_dim = model_dim
+        self.bins = bins
 
-        # Input dimension is hidden state + all embedded latent dimensions
-        input_dim = hidden_dim + embedding_dim * latent_dim
+        # The hidden layers of the three heads side by side: [decoder | reward | continue].
+        # Split into an h and a z part so the input never has to be concatenated
+        self.lin_h = nn.Linear(hidden_dim, 3 * model_dim)
+        self.lin_z = nn.Linear(embedding_dim * latent_dim, 3 * model_dim, bias=False)
+        init_split_linear(hidden_dim + embedding_dim * latent_dim, self.lin_h, self.lin_z)
 
-        self.model = nn.Sequential(
-            nn.Linear(input_dim, model_dim),
-            nn.ReLU(),
-            nn.Linear(model_dim, output_dim),
+        self.decoder = nn.Linear(model_dim, obs_size)
+        self.reward_predictor = nn.Linear(model_dim, 1)
+        self.continue_predictor = nn.Sequential(
+            nn.Linear(model_dim, 1),
             nn.Sigmoid()
         )
 
-    def forward(self, h, z):    # TODO: Check if z is a list of tensors
+    def forward(self, h, z):
         """
         h: Tensor of shape (batch_size, hidden_dim)
         z: Tensor of shape (batch_size, latent_dim * embedding_dim)
+        returns: x̂ (batch_size, obs_size), r̂ (batch_size, 1), ĉ (batch_size, 1)
         """
-    
-        # Concatenate h with embedded latent variables
-        input_tensor = torch.cat([h, z], dim=-1)
-        return self.model(input_tensor)
-
-
-class Decoder(nn.Module):
-    def __init__(self, hidden_dim, latent_dim, embedding_dim, output_dim, model_dim):
-        """
-        Parameters:
-        - hidden_dim: Dimension of the recurrent hidden state h_t
-        - latent_dim: Number of categorical latent variables (each with its own classes)
-        - embedding_dim: Embedding size for each categorical variable
-        - output_dim: Dimension of the predicted output (e.g., reward distribution)
-        - model_dim: Number of units in each hidden layer
-        """
-        super().__init__()
-        self.hidden_dim = hidden_dim
-        self.latent_dim = latent_dim
-        self.embedding_dim = embedding_dim
-        self.output_dim = output_dim
-        self.model_dim = model_dim
-        
-        input_dim = hidden_dim + embedding_dim * latent_dim
-
-        self.model = nn.Sequential(
-            nn.Linear(input_dim, model_dim),
-            nn.ReLU(),
-            nn.Linear(model_dim, output_dim),
-        )
+        hidden = F.relu(self.lin_h(h) + self.lin_z(z))
+        x_hidden, r_hidden, c_hidden = hidden.chunk(3, dim=-1)
+        return self.decoder(x_hidden), self.reward_predictor(r_hidden), self.continue_predictor(c_hidden)
 
-    def forward(self, h, z):
+    def predict_reward_continue(self, h, z):
         """
+        Only the reward and continue heads, used during imagination where no observation is decoded
         h: Tensor of shape (batch_size, hidden_dim)
         z: Tensor of shape (batch_size, latent_dim * embedding_dim)
+        returns: r̂ (batch_size, 1), ĉ (batch_size, 1)
         """
-        # Concatenate h with embedded latent variables
-        input_tensor = torch.cat([h, z], dim=-1)
-        return self.model(input_tensor)
+        # The reward and continue hidden units are the last 2 * model_dim rows of the shared layer
+        hidden = F.relu(F.linear(h, self.lin_h.weight[self.model_dim:], self.lin_h.bias[self.model_dim:])
+                        + F.linear(z, self.lin_z.weight[self.model_dim:]))
+        r_hidden, c_hidden = hidden.chunk(2, dim=-1)
+        return self.reward_predictor(r_hidden), self.continue_predictor(c_hidden)
     
-class WorldModel():
-    def __init__(self, latent_dim, action_dim, obs_size, latent_categories_size, model_dim, bins, min_reward, max_reward, num_blocks=8, device='cpu'):
+def kl_losses(z_log_prob, z_dyn_log_prob, latent_categories_size):
+    """
+    Dynamics and encoder KL losses between the encoder's and the dynamics predictor's distributions.
+    Both are mixed with 1% uniform first: log(0.99 * p + 0.01 / K), computed directly from log(p)
+    without going back to probabilities.
+    z_log_prob: (batch_size, latent_categories_size), log-probabilities of the encoder
+    z_dyn_log_prob: (batch_size, latent_categories_size), log-probabilities of the dynamics predictor
+    returns: loss_dyn, loss_enc
+    """
+    uniform_log_prob = z_log_prob.new_tensor(math.log(0.01 / latent_categories_size))
+    z_log_prob = torch.logaddexp(z_log_prob + math.log(0.99), uniform_log_prob)
+    z_dyn_log_prob = torch.logaddexp(z_dyn_log_prob + math.log(0.99), uniform_log_prob)
+
+    loss_dyn = torch.clamp(F.kl_div(z_dyn_log_prob, z_log_prob.detach(), reduction="batchmean", log_target=True), max=1)     # have to switch positions
+    loss_enc = torch.clamp(F.kl_div(z_dyn_log_prob.detach(), z_log_prob, reduction="batchmean", log_target=True), max=1)
+    return loss_dyn, loss_enc
+
+class WorldModel(nn.Module):
+    def __init__(self, latent_dim, action_dim, obs_size, latent_categories_size, model_dim, bins, min_reward, max_reward, num_blocks=8, device='cpu', compile_modules=False, use_cuda_graph=False):
         super().__init__()
         self.latent_dim = latent_dim
         self.action_dim = action_dim
@@ -257,26 +320,102 @@ class WorldModel():
         self.model_dim = model_dim
         self.bins = bins
         self.num_blocks = num_blocks
-        self.device = device
+        self.device = torch.device(device)
         self.min_reward = min_reward
         self.max_reward = max_reward
         
         
-        self.sequence_model = SequenceModel(latent_dim, latent_categories_size, action_dim, model_dim, num_blocks, device).to(device)
-        self.encoder = Encoder(model_dim * num_blocks, obs_size, latent_dim, latent_categories_size, model_dim).to(device)
-        self.dynamics_predictor = DynamicsPredictor(model_dim * num_blocks, latent_dim, latent_categories_size, model_dim).to(device)
-        self.reward_predictor = RewardPredictor(model_dim * num_blocks, latent_dim, latent_categories_size, 1, model_dim, bins).to(device)
-        self.continue_predictor = ContinuePredictor(model_dim * num_blocks, latent_dim, latent_categories_size, 1, model_dim).to(device)
-        self.decoder = Decoder(model_dim * num_blocks, latent_dim, latent_categories_size, obs_size, model_dim).to(device)
-
-        params = list(self.sequence_model.parameters()) + \
-                list(self.encoder.parameters()) + \
-                list(self.dynamics_predictor.parameters()) + \
-                list(self.reward_predictor.parameters()) + \
-                list(self.continue_predictor.parameters()) + \
-                list(self.decoder.parameters())
-                
-        self.optimizer = optim.Adam(params, lr=4e-3)
+        self.sequence_model = SequenceModel(latent_dim, latent_categories_size, action_dim, model_dim, num_blocks, self.device)
+        self.encoder = Encoder(model_dim * num_blocks, obs_size, latent_dim, latent_categories_size, model_dim)
+        self.dynamics_predictor = DynamicsPredictor(model_dim * num_blocks, latent_dim, latent_categories_size, model_dim)
+        self.heads = PredictionHeads(model_dim * num_blocks, latent_dim, latent_categories_size, obs_size, model_dim, bins)
+        # Values of the action bins, the imagined actions are their expected value
+        self.register_buffer("bin_centers", torch.linspace(-1, 1, bins))
+        # All sub-modules are registered on the world model, so they are moved in one call
+        self.to(self.device)
+
+        self.optimizer = optim.Adam(self.parameters(), lr=4e-3, foreach=True)
+
+        # The MLPs are called with fixed shapes in imagine and train, so compiling them with
+        # CUDA graphs removes the per-call launch overhead. The sequence model is left
+        # eager, compiling its loop over seq_len would unroll it
+        self.compile_modules = compile_modules
+        if compile_modules:
+            for module in (self.encoder, self.dynamics_predictor, self.heads):
+                module.compile(mode="reduce-overhead", dynamic=False)
+        # Module.compile only wraps forward, the reward/continue-only path of imagine is compiled on its own
+        self._predict_reward_continue = (
+            torch.compile(self.heads.predict_reward_continue, mode="reduce-overhead", dynamic=False)
+            if compile_modules else self.heads.predict_reward_continue)
+
+        # The smoothing and both KL losses are elementwise passes over the same tensors,
+        # compiling them lets Inductor fuse them into a few kernels
+        self._kl_losses = torch.compile(kl_losses) if compile_modules else kl_losses
+
+        # The dynamics predictor in train is small and independent of the encoder and the heads,
+        # on the GPU it runs on its own stream so they can overlap.
+        # Not needed with compiled modules, the CUDA graphs already hide the launch overhead
+        if self.device.type == "cuda" and not compile_modules:
+            self.streams = [torch.cuda.Stream(device=self.device)]
+        else:
+            self.streams = None
+
+        # bfloat16 autocast in train where the GPU supports it. bfloat16 has the
+        # range of float32, so no gradient scaling is needed
+        self.use_autocast = self.device.type == "cuda" and torch.cuda.is_bf16_supported()
+
+        # Pinned host buffers for staging CPU batches in train, see _to_device
+        self._pinned = {}
+
+        # Optionally replay the world model part of each imagination step from a CUDA graph,
+        # see _graphed_world_step. Compiled modules already run from CUDA graphs
+        self.use_cuda_graph = use_cuda_graph and self.device.type == "cuda" and not compile_modules
+        self._imagine_graphs = {}
+
+    def _side_stream(self, i):
+        """
+        Context that runs the enclosed ops on the i-th side stream, after everything
+        already queued on the current stream. Does nothing on the CPU.
+        """
+        if self.streams is None:
+            return contextlib.nullcontext()
+        self.streams[i].wait_stream(torch.cuda.current_stream())
+        return torch.cuda.stream(self.streams[i])
+
+    def _join_side_streams(self, *tensors):
+        """
+        Makes the current stream wait for all side streams. The given tensors were
+        created on a side stream and are used on the current stream from now on.
+        """
+        if self.streams is None:
+            return
+        current_stream = torch.cuda.current_stream()
+        for stream in self.streams:
+            current_stream.wait_stream(stream)
+        for tensor in tensors:
+            tensor.record_stream(current_stream)
+
+    def _to_device(self, name, tensor):
+        """
+        Moves a training batch to the model's device. CPU batches are copied into a
+        reused pinned buffer first, so the transfer to the GPU can be asynchronous.
+        """
+        if tensor.device.type != "cpu" or self.device.type != "cuda":
+            return tensor.to(self.device)
+
+        buffer, copied = self._pinned.get(name, (None, None))
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        elif copied is not None:
+            # The previous transfer has to finish reading the buffer before it is overwritten
+            copied.synchronize()
+        buffer.copy_(tensor)
+        tensor = buffer.to(self.device, non_blocking=True)
+
+        copied = torch.cuda.Event()
+        copied.record()
+        self._pinned[name] = (buffer, copied)
+        return tensor
 
     def get_latent(self, h, x):
         """
@@ -284,7 +423,9 @@ class WorldModel():
         x = (obs_size)
         returns: z = (1, latent_dim, latent_categories_size)
         """
-        z, _ = self.encoder(h, x.unsqueeze(dim=0))
+        # Acting never calls backward, so no autograd graph is left pending for the compiled modules
+        with torch.no_grad():
+            z, _ = self.encoder(h, x.unsqueeze(dim=0))
         return z
     def get_recurrent_hidden(self, h, z, a):
         """
@@ -292,65 +433,128 @@ class WorldModel():
         z = (1, latent_dim, latent_categories_size)
         a = (action_dim)
         """
-        h = h.view(1,1,-1)
-        z = z.view(1,1,-1)
-        a = a.view(1,1,-1)
-
-        new_h = self.sequence_model(z, a, h) # (batch_size, seq_len, num_blocks * model_dim), but seq_len is 1
-        new_h = new_h.squeeze(dim=1)
+        with torch.no_grad():
+            new_h = self.sequence_model.step(z.view(1, -1), a.view(1, -1), h.view(1, -1))   # (1, num_blocks * model_dim)
         return new_h
     
     def imagine(self, z_0, actor, imag_horizon):
         '''
-        
+        z_0: (batch_size, latent_dim, latent_categories_size)
         '''
-        h = []
-        z = []
-        r = []
-        c = []
+        #TODO: do we need probs or just the sampled values?
+        batch_size = z_0.shape[0]
+        if self.compile_modules:
+            torch.compiler.cudagraph_mark_step_begin()
+
+        # The outputs without gradients are allocated once and filled in step by step. The action
+        # probabilities carry the actor's graph, writing them into a buffer would copy the whole
+        # buffer's gradient in backward for every step, so they are stacked once at the end
+        h = torch.empty(batch_size, imag_horizon + 1, self.model_dim * self.num_blocks, device=self.device)  # (batch_size, imag_horizon + 1, recurrent_hidden_dim * num_blocks)
+        z = torch.empty(batch_size, imag_horizon + 1, self.latent_dim * self.latent_categories_size, device=self.device)  # (batch_size, imag_horizon + 1, latent_dim * latent_categories_size)
         a_all_probs = []
         a_taken_probs = []
-        #TODO: this is only pseudocode almost, need to check dimensions
-        #TODO: do we need probs or just the sampled values?
-        h_t = self.get_default_hidden(z_0.shape[0])
-        z_t = z_0
-        for _ in range(imag_horizon):
-            z_t_long = z_t.view(-1, self.latent_dim * self.latent_categories_size)  # (batch_size, latent_dim * latent_categories_size)
-            a_t_cat, a_t_all_probs = actor(h_t, z_t_long)
-            a_t_index = torch.argmax(a_t_cat, dim=-1, keepdim=True)
-            a_t_taken_probs = torch.gather(a_t_all_probs, dim=-1, index=a_t_index)  
-            a_t_cat = a_t_cat.view(-1, self.action_dim, self.bins)  # (batch_size, action_dim, action_bins)
-
-            r_t = self.reward_predictor(h_t, z_t_long) # (batch_size, 1)
-            c_t_cat = self.continue_predictor(h_t, z_t_long)                # (batch_size, 1)
-
-            a_t = utils.get_value_from_distribution(a_t_cat, -1, 1)     # (batch_size, action_dim)
-            c_t = (c_t_cat > 0.5).float().to(self.device)               # (batch_size, 1)
-
-            h.append(h_t)
-            z.append(z_t_long)
-            a_all_probs.append(a_t_all_probs)
-            a_taken_probs.append(a_t_taken_probs)
-            r.append(r_t)
-            c.append(c_t)
+        r = torch.empty(batch_size, imag_horizon, 1, device=self.device)  # (batch_size, imag_horizon, 1)
+        c = torch.empty(batch_size, imag_horizon, 1, device=self.device)  # (batch_size, imag_horizon, 1)
+
+        h_t = self.get_default_hidden(batch_size)
+        z_t = z_0.view(batch_size, -1)
+        for t in range(imag_horizon):
+            # h_t and z_t are stored before the step, so the buffer writes never depend on an
+            # output of a later compiled call (each call gets its own graph node while backwards are pending)
+            h[:, t] = h_t
+            z[:, t] = z_t
+            h_new, z_new, a_t_all_probs, a_t_taken_probs, r_t, c_t = self._imagine_step(h_t, z_t, actor)
 
-            h_new = self.sequence_model(z_t_long.unsqueeze(dim=1), a_t.unsqueeze(dim=1), h_t.unsqueeze(dim=1))
-            z_new, _ = self.dynamics_predictor(h_new)
+            a_all_probs.append(a_t_all_probs)
+            a_taken_probs.append(a_t_taken_probs.squeeze(dim=-1))
+            r[:, t] = r_t
+            c[:, t] = c_t
 
-            h_t = h_new.view(-1, self.model_dim * self.num_blocks)
+            h_t = h_new
             z_t = z_new
-        h.append(h_t)
-        z.append(z_t.view(-1, self.latent_dim * self.latent_categories_size))
-        
-        h = torch.stack(h, dim=1) # (batch_size, imag_horizon + 1, recurrent_hidden_dim * num_blocks)
-        z = torch.stack(z, dim=1) # (batch_size, imag_horizon + 1, latent_dim * latent_categories_size)
-        a_all_probs = torch.stack(a_all_probs, dim=1) # (batch_size, imag_horizon, action_dim, bins)
-        a_taken_probs = torch.stack(a_taken_probs, dim=1).squeeze(dim=-1) # (batch_size, imag_horizon, action_dim)
-        r = torch.stack(r, dim=1) # (batch_size, imag_horizon, 1)
-        c = torch.stack(c, dim=1) # (batch_size, imag_horizon, 1)
+        h[:, imag_horizon] = h_t
+        z[:, imag_horizon] = z_t
+        a_all_probs = torch.stack(a_all_probs, dim=1)       # (batch_size, imag_horizon, action_dim, bins)
+        a_taken_probs = torch.stack(a_taken_probs, dim=1)   # (batch_size, imag_horizon, action_dim)
 
-        
         return h, z, a_all_probs, a_taken_probs, r, c
+
+    def _imagine_step(self, h_t, z_t, actor):
+        '''
+        h_t: (batch_size, model_dim * num_blocks)
+        z_t: (batch_size, latent_dim * latent_categories_size)
+        returns: h_{t+1}, z_{t+1} and the action probabilities, reward and continue flag at step t
+        '''
+        a_t_cat, a_t_all_probs = actor(h_t, z_t)
+        a_t_index = torch.argmax(a_t_cat, dim=-1, keepdim=True)
+        a_t_taken_probs = torch.gather(a_t_all_probs, dim=-1, index=a_t_index)      # (batch_size, action_dim, 1)
+
+        a_t = (a_t_cat * self.bin_centers).sum(dim=-1)              # (batch_size, action_dim)
+
+        if self.use_cuda_graph:
+            h_new, z_new, r_t, c_t = self._graphed_world_step(h_t, z_t, a_t)
+        else:
+            # The eager step keeps the gradient from the actions through the dynamics into the next
+            # actor call. With compiled modules it runs without gradients like the graphed step, so no
+            # backward is left pending in the CUDA-graph tree
+            with torch.set_grad_enabled(torch.is_grad_enabled() and not self.compile_modules):
+                h_new, z_new, r_t, c_t = self._world_step(h_t, z_t, a_t)
+        return h_new, z_new, a_t_all_probs, a_t_taken_probs, r_t, c_t
+
+    def _world_step(self, h_t, z_t, a_t):
+        '''
+        The world model part of an imagination step
+        h_t: (batch_size, model_dim * num_blocks)
+        z_t: (batch_size, latent_dim * latent_categories_size)
+        a_t: (batch_size, action_dim)
+        returns: h_{t+1}, z_{t+1} and the reward and continue flag at step t
+        '''
+        r_t, c_t_cat = self._predict_reward_continue(h_t, z_t)   # (batch_size, 1), (batch_size, 1)
+        c_t = (c_t_cat > 0.5).float()           # (batch_size, 1)
+
+        # h and z stay flat for the whole rollout: (batch_size, model_dim * num_blocks) and
+        # (batch_size, latent_dim * latent_categories_size)
+        h_new = self.sequence_model.step(z_t, a_t, h_t)
+        z_new, _ = self.dynamics_predictor(h_new)
+        z_new = z_new.flatten(start_dim=1)
+        return h_new, z_new, r_t, c_t
+
+    def _graphed_world_step(self, h_t, z_t, a_t):
+        '''
+        _world_step replayed from a CUDA graph, which is captured on the first call for each batch size.
+        It runs without gradients: the imagined states are only used detached by the critic, and the
+        actor is trained on its own action probabilities
+        '''
+        batch_size = h_t.shape[0]
+        if batch_size not in self._imagine_graphs:
+            self._imagine_graphs[batch_size] = self._capture_world_step(h_t, z_t, a_t)
+        graph, static_inputs, static_outputs = self._imagine_graphs[batch_size]
+
+        with torch.no_grad():
+            for static_input, value in zip(static_inputs, (h_t, z_t, a_t)):
+                static_input.copy_(value)
+        graph.replay()
+        # The next replay overwrites the static outputs
+        return tuple(output.clone() for output in static_outputs)
+
+    def _capture_world_step(self, h_t, z_t, a_t):
+        '''
+        returns: the CUDA graph of _world_step, its static input and its static output tensors
+        '''
+        static_inputs = (h_t.detach().clone(), z_t.detach().clone(), a_t.detach().clone())
+
+        # A few warm-up iterations on a side stream before the capture, as CUDA graphs require
+        warmup_stream = torch.cuda.Stream(device=self.device)
+        warmup_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(warmup_stream), torch.no_grad():
+            for _ in range(3):
+                self._world_step(*static_inputs)
+        torch.cuda.current_stream().wait_stream(warmup_stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(), torch.cuda.graph(graph):
+            static_outputs = self._world_step(*static_inputs)
+        return graph, static_inputs, static_outputs
     
     def get_default_hidden(self, batch_size=1):
         return self.sequence_model.get_default_hidden(batch_size)
@@ -365,51 +569,62 @@ class WorldModel():
         """
         batch_size = x.shape[0]
         seq_len = x.shape[1]
+        x = self._to_device("x", x)
+        a = self._to_device("a", a)
+        r = self._to_device("r", r)
+        c = self._to_device("c", c)
+        z_memory = self._to_device("z_memory", z_memory)
+        if self.compile_modules:
+            torch.compiler.cudagraph_mark_step_begin()
         # Train the world model
         l1_loss = nn.L1Loss()
         mse_loss = nn.MSELoss()
-        kl_loss = nn.KLDivLoss(reduction="batchmean", log_target=True)
 
         
         # Calculate the hidden states from the old latents, and the new latents
         h_0 = self.get_default_hidden(batch_size)
 
-        h = self.sequence_model(z_memory.view(batch_size, seq_len, -1), a, h_0).squeeze(dim=1)
-        h = torch.cat([h_0.unsqueeze(dim=1), h[:,:-1]], dim=1)
-        h = h.view(batch_size * seq_len, -1)
-         # (batch_size * seq_len, latent_dim, latent_categories_size)
-        z_new, z_prob = self.encoder(h, x.view(batch_size * seq_len, -1))
+        # Mixed precision forward on the GPU, the sampling and the KL losses stay in float32
+        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.use_autocast):
+            # The latents at step t are computed from the previous hidden states [h_0, ..., h_{L-1}]
+            _, h = self.sequence_model(z_memory.view(batch_size, seq_len, -1), a, h_0, return_prior=True)
+            # The sequence model keeps its states time-major, so the batch is flattened in
+            # (seq_len, batch_size) order: a view for h, only the small inputs are transposed
+            h = h.transpose(0, 1).reshape(seq_len * batch_size, -1)
+            x = x.transpose(0, 1).reshape(seq_len * batch_size, -1)
+            r = r.transpose(0, 1).reshape(seq_len * batch_size, 1)
+            c = c.transpose(0, 1).reshape(seq_len * batch_size, 1)
+
+            # The dynamics predictor only depends on h, so it can run next to the encoder
+            with self._side_stream(0):
+                _, z_dyn_log_prob = self.dynamics_predictor(h)
+             # (batch_size * seq_len, latent_dim, latent_categories_size)
+            z_new, z_log_prob = self.encoder(h, x)
         
-        z_new_long = z_new.view(batch_size * seq_len, -1)
-        x = x.view(batch_size * seq_len, -1)
-        r = r.view(batch_size * seq_len, 1)
-        c = c.view(batch_size * seq_len, 1)
-        # L_pred
-        x_out = self.decoder(h, z_new_long)
-        r_out = self.reward_predictor(h, z_new_long)
-        #c_out = self.continue_predictor(h, z_new_long)
-        loss_pred = mse_loss(x_out,x) + l1_loss(r_out,r) #+ F.cross_entropy(c_out, c)
-
-        # L_dyn + L_enc
-        # already computed
-        # z_new, z_prob = self.encoder(h, x)
-        _, z_dyn_prob = self.dynamics_predictor(h)
-
-        z_prob = torch.log(z_prob * 0.99 + 0.01 / self.latent_categories_size)
-        z_dyn_prob = torch.log(z_dyn_prob * 0.99 + 0.01 / self.latent_categories_size)
-
-        loss_dyn = torch.clamp(kl_loss(z_dyn_prob.view(-1, self.latent_categories_size), z_prob.detach().view(-1, self.latent_categories_size)), max=1)     # have to switch positions
-        loss_enc = torch.clamp(kl_loss(z_dyn_prob.detach().view(-1, self.latent_categories_size), z_prob.view(-1, self.latent_categories_size)), max=1)
-        # L_total
-
-        loss_total = loss_pred + loss_dyn + 0.1 * loss_enc
+            z_new_long = z_new.view(seq_len * batch_size, -1)
+            # L_pred
+            x_out, r_out, c_out = self.heads(h, z_new_long)
+            self._join_side_streams(z_dyn_log_prob)
+            loss_pred = mse_loss(x_out,x) + l1_loss(r_out.float(),r) #+ F.cross_entropy(c_out, c)
+
+            # L_dyn + L_enc
+            # already computed
+            # z_new, z_log_prob = self.encoder(h, x)
+            # _, z_dyn_log_prob = self.dynamics_predictor(h)
+
+            loss_dyn, loss_enc = self._kl_losses(z_log_prob.view(-1, self.latent_categories_size),
+                                                 z_dyn_log_prob.view(-1, self.latent_categories_size),
+                                                 self.latent_categories_size)
+            # L_total
+
+            loss_total = loss_pred + loss_dyn + 0.1 * loss_enc
         
 
         self.optimizer.zero_grad()
         loss_total.backward()
         self.optimizer.step()
         #print(loss_total.item())
-        return (loss_pred, loss_dyn, 0.1 * loss_enc), z_new.view(batch_size, seq_len, self.latent_dim, self.latent_categories_size)
+        return (loss_pred, loss_dyn, 0.1 * loss_enc), z_new.view(seq_len, batch_size, self.latent_dim, self.latent_categories_size).transpose(0, 1)
         
 
 